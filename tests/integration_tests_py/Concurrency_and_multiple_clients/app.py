@@ -1,43 +1,40 @@
 ﻿#advanced_general_server.cpp
 import asyncio
-import websockets
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import connect, run
+
+_SET_INDEXED = b"set_data_indexed_true:"
+_GET_DATA = b"get_data:"
+_FIND_BY = b"find_by:"
 
 async def client_task(client_id, port=9000):
     uri = f"ws://localhost:{port}"
     username = f"user_{client_id}"
-
-    # Prepare headers
-    headers = {
-        "x-client-id": str(client_id),
-        "x-device-id": f"dev_{client_id}"
-        # "x-session-token": "...",  # Add if necessary
-    }
-
-    async with websockets.connect(uri, additional_headers=headers) as websocket:
+    username_b = username.encode()
+
+    # Build every request up front. They still go out one at a time: the
+    # server runs RPC handlers on a thread pool, so pipelined requests could
+    # be handled out of order, and get_data/find_by depend on the first step.
+    steps = [
+        ("set_data_indexed_true", _SET_INDEXED + username_b,
+         lambda r: r == "OK"),
+        ("get_data", _GET_DATA,
+         lambda r: r == username),
+        ("find_by", _FIND_BY + username_b,
+         lambda r: r.startswith("S")),
+    ]
+
+    async with connect(uri, client_id) as websocket:
         print(f"[Client {client_id}] Connecting...")
 
-        # STEP 1: set_data_indexed_true
-        msg1 = f"set_data_indexed_true:{username}".encode()
-        await websocket.send(msg1)
-        resp1 = await websocket.recv()
-        resp1_str = resp1.decode()
-        print(f"[Client {client_id}] set_data_indexed_true response: {resp1_str}")
-        assert resp1_str == "OK", f"Client {client_id} set_data_indexed_true failed"
-
-        # STEP 2: get_data
-        await websocket.send(b"get_data:")
-        resp2 = await websocket.recv()
-        resp2_str = resp2.decode()
-        print(f"[Client {client_id}] get_data response: {resp2_str}")
-        assert resp2_str == username, f"Client {client_id} get_data mismatch"
-
-        # STEP 3: find_by
-        msg3 = f"find_by:{username}".encode()
-        await websocket.send(msg3)
-        resp3 = await websocket.recv()
-        resp3_str = resp3.decode()
-        print(f"[Client {client_id}] find_by response: {resp3_str}")
-        assert resp3_str.startswith("S"), f"Client {client_id} find_by failed"
+        for name, msg, check in steps:
+            await websocket.send(msg)
+            resp = (await websocket.recv()).decode()
+            print(f"[Client {client_id}] {name} response: {resp}")
+            assert check(resp), f"Client {client_id} {name} failed"
 
         print(f"[Client {client_id}] SUCCESS")
 
@@ -45,4 +42,4 @@ async def concurrency_test(num_clients=10):
     tasks = [client_task(i) for i in range(num_clients)]
     await asyncio.gather(*tasks)
 
-asyncio.run(concurrency_test(10))
+run(concurrency_test(10))
@@ -1,23 +1,21 @@
 ﻿#!/usr/bin/env python3
 #main.cpp
-import asyncio
-import websockets
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import connect, run
 
 SERVER_HOST = "localhost"
 SERVER_PORT = 9011
 SERVER_URI = f"ws://{SERVER_HOST}:{SERVER_PORT}"
 
-HEADERS = {
-    "x-client-id": "1",
-    "x-device-id": "dev_1"
-}
-
 def print_result(name, ok):
     print(f"[{'OK' if ok else 'FAIL'}] {name}")
 
 async def test_echo_simple_text():
     try:
-        async with websockets.connect(SERVER_URI, additional_headers=HEADERS) as ws:
+        async with connect(SERVER_URI) as ws:
             await ws.send(b"echo:hello world")
             resp = await ws.recv()
             if not isinstance(resp, (bytes, bytearray)):
@@ -31,7 +29,7 @@ async def test_echo_simple_text():
 
 async def test_error_simple_text():
     try:
-        async with websockets.connect(SERVER_URI, additional_headers=HEADERS) as ws:
+        async with connect(SERVER_URI) as ws:
             await ws.send(b"unknown:payload")
             resp = await ws.recv()
             if not isinstance(resp, (bytes, bytearray)):
@@ -51,4 +49,4 @@ async def main():
     print("E2E tests passed")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run(main())
@@ -1,14 +1,12 @@
-﻿import asyncio
-import websockets
+﻿import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import connect, run
 
 async def error_propagation_test():
     uri = "ws://localhost:9002"
-    headers = {
-        "x-client-id": "1",
-        "x-device-id": "dev_1"
-    }
-
-    async with websockets.connect(uri, additional_headers=headers) as websocket:
+    async with connect(uri) as websocket:
         # Test 1: invalid method
         print("[TEST] Sending invalid method...")
         await websocket.send(b"invalid_method:xyz")
@@ -35,4 +33,4 @@ async def error_propagation_test():
 
         print("[TEST] SUCCESS: Error propagation test passed!")
 
-asyncio.run(error_propagation_test())
+run(error_propagation_test())
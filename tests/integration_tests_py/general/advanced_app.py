@@ -1,14 +1,12 @@
-﻿import asyncio
-import websockets
+﻿import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import connect, run
 
 async def session_persistence_test():
     uri = "ws://localhost:9000"
-    headers = {
-        "x-client-id": "1",
-        "x-device-id": "dev_1"
-    }
-
-    async with websockets.connect(uri, additional_headers=headers) as websocket:
+    async with connect(uri) as websocket:
         print("[TEST] Sending set_data_indexed_false...")
         await websocket.send(b"set_data_indexed_false:brocan")
         resp1 = await websocket.recv()
@@ -30,7 +28,10 @@ async def session_persistence_test():
         print(f"Response: '{resp3_str}'")
         assert resp3_str.strip() == "", "find_by should return empty before indexed_true"
 
-    async with websockets.connect(uri, additional_headers=headers) as websocket:
+    # Reconnect only after the first socket is closed: the server drops the
+    # older connection when the same client/device id connects again, so
+    # opening this one early would cut off the find_by reply above.
+    async with connect(uri) as websocket:
         print("[TEST] Sending set_data_indexed_true...")
         await websocket.send(b"set_data_indexed_true:brocan")
         resp4 = await websocket.recv()
@@ -47,4 +48,4 @@ async def session_persistence_test():
 
         print("[TEST] SUCCESS: Session persistency test passed!")
 
-asyncio.run(session_persistence_test())
+run(session_persistence_test())
@@ -1,13 +1,15 @@
 ﻿import asyncio
-import websockets
+import sys
+from pathlib import Path
 
-async def test_rpc(method, payload):
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import connect, run
+
+async def test_rpc(method, payload, client_id="1"):
     uri = "ws://127.0.0.1:9000"
-    headers = {
-        "x-client-id": "1",
-        "x-device-id": "dev_1"
-    }
-    async with websockets.connect(uri, additional_headers=headers) as websocket:
+    # The server closes an older connection when the same client-id/device-id
+    # reconnects, so concurrent calls each need their own identity.
+    async with connect(uri, client_id) as websocket:
         message = f"{method}:{payload}"
         binary_message = message.encode('utf-8')
 
@@ -22,12 +24,17 @@ async def test_rpc(method, payload):
         else:
             print(f"[Client ⚠️] Text response received: {response}")
 
-# Normal successful call
-asyncio.run(test_rpc("login", "test payload"))
-asyncio.run(test_rpc("test.middleware", "another payload"))
+async def main():
+    await asyncio.gather(
+        # Normal successful call
+        test_rpc("login", "test payload", "1"),
+        test_rpc("test.middleware", "another payload", "2"),
+
+        # Chain with missing next()
+        test_rpc("stuck.method", "should fail", "3"),
 
-# Chain with missing next()
-asyncio.run(test_rpc("stuck.method", "should fail"))
+        # Middleware that throws
+        test_rpc("throw.method", "should throw", "4"),
+    )
 
-# Middleware that throws
-asyncio.run(test_rpc("throw.method", "should throw"))
+run(main())
@@ -1,5 +1,10 @@
 import asyncio, websockets, json
 import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from ws_helpers import CONNECT_KWARGS, run
 
 URI = "ws://127.0.0.1:9000"
 
@@ -15,9 +20,9 @@ def make_headers():
         ("x-device-id", did)
     ]
 
-async def run():
+async def main():
     # ---- 1. main connection ----
-    async with websockets.connect(URI, additional_headers=make_headers()) as ws:
+    async with websockets.connect(URI, additional_headers=make_headers(), **CONNECT_KWARGS) as ws:
         await ws.send(pack("set.nonidx", "Jane"))
         print("set.nonidx ➜", (await ws.recv()).decode())
 
@@ -41,11 +46,11 @@ async def run():
         await ws.send(pack("bye"))
     await asyncio.sleep(2)
     # ---- 2. new connection (no old session) ----
-    async with websockets.connect(URI, additional_headers=make_headers()) as ws2:
+    async with websockets.connect(URI, additional_headers=make_headers(), **CONNECT_KWARGS) as ws2:
         await ws2.send(pack("find.city", "Paris"))
         print("find.city(Paris, 0) ➜", (await ws2.recv()).decode())
 
         await ws2.send(pack("list.sessions"))
         print("list.sessions (should be 1) ➜", (await ws2.recv()).decode())
 
-asyncio.run(run())
+run(main())
@@ -0,0 +1,143 @@
+"""Connection helpers shared by the integration test clients.
+
+Scripts live one directory below this file and pull it in with
+``sys.path.insert(0, str(Path(__file__).resolve().parents[1]))``.
+"""
+import asyncio
+import logging
+import logging.handlers
+import socket
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+import websockets
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+# Test frames are a few bytes each: skip the permessage-deflate handshake,
+# per-message size checks and the 16-frame receive backpressure. The
+# asyncio client has no read_limit; the kernel socket buffer covers reads.
+CONNECT_KWARGS = {
+    "compression": None,
+    "max_size": None,
+    "max_queue": None,
+    "write_limit": 2**20,
+}
+
+
+@lru_cache(maxsize=None)
+def make_headers(client_id, device_id=None):
+    """Identity headers for a client; device id defaults to ``dev_<client_id>``.
+
+    Returned as an immutable tuple of pairs so the cached value can be
+    handed to every connection without being copied.
+    """
+    client_id = str(client_id)
+    return (
+        ("x-client-id", client_id),
+        ("x-device-id", device_id or f"dev_{client_id}"),
+    )
+
+
+@dataclass
+class ClientCtx:
+    """Identity of one test client.
+
+    ``session_token`` starts empty and is filled from the first handshake
+    response, so reconnects with the same context resume the same session.
+    """
+    client_id: str
+    device_id: Optional[str] = None
+    session_token: Optional[str] = None
+
+    def headers(self):
+        hdrs = make_headers(self.client_id, self.device_id)
+        if self.session_token:
+            hdrs += (("x-session-token", self.session_token),)
+        return hdrs
+
+
+def make_logger(name, debug):
+    """Logger for a test client's tracing, printed to stdout as bare messages.
+
+    With ``debug`` on, every record is written as it is logged so the trace
+    stays in order with the script's own prints and survives a hang or kill.
+    Otherwise only WARNING and up are kept, buffered 1000 at a time and
+    flushed early on ERROR or at exit.
+    """
+    logger = logging.getLogger(name)
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(logging.Formatter("%(message)s"))
+    if debug:
+        logger.addHandler(out)
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.addHandler(logging.handlers.MemoryHandler(1000, target=out))
+        logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    return logger
+
+
+def client_ctx(prefix, n, device_id=None):
+    """Fresh identity ``<prefix>-<n>`` for test ``n`` of a suite.
+
+    The server keys a session (pending queue, counters, TTL, duplicate
+    filter) on the identity and closes the older connection when the same
+    identity reconnects, so tests that overlap need one context each. Tests
+    that never reconnect may instead share one context and connection, as
+    long as their request payloads differ: the duplicate filter is keyed on
+    payload per session and would swallow a repeat. The token is filled on
+    the first handshake.
+    """
+    return ClientCtx(f"{prefix}-{n}", device_id)
+
+
+# Request payloads several suites send, encoded once.
+ECHO_PING   = b"echo:ping"
+COUNTER_INC = b"counter:inc"
+
+
+def connect(uri, client_id="1", device_id=None, **kwargs):
+    """``websockets.connect`` with the identity headers and
+    ``CONNECT_KWARGS`` filled in; ``kwargs`` override the defaults."""
+    return websockets.connect(
+        uri, additional_headers=make_headers(client_id, device_id),
+        **{**CONNECT_KWARGS, **kwargs})
+
+
+def session_token(ws):
+    """The ``x-session-token`` from the handshake response, or None.
+
+    ``response_headers`` is the legacy client's attribute; the asyncio
+    client exposes the same headers on ``response``.
+    """
+    hdrs = getattr(ws, "response_headers", None) or ws.response.headers
+    return hdrs.get("x-session-token")
+
+
+def set_nodelay(ws):
+    """Make sure Nagle can't hold back small frames on ``ws``.
+
+    asyncio already sets TCP_NODELAY on the TCP transports it creates; this
+    pins it explicitly for event loops or transports that do not.
+    """
+    sock = ws.transport.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def run(main):
+    """``asyncio.run`` on uvloop when it is installed."""
+    if uvloop is None:
+        return asyncio.run(main)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(main)